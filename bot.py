@@ -1,58 +1,379 @@
 import os
+import asyncio
+import atexit
+import functools
+import hashlib
+import itertools
 import logging
+import logging.handlers
+import queue
+import time
+from collections import OrderedDict, deque
 from telegram import Update
+from telegram import error as telegram_error
+from telegram.constants import ChatAction
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
 import google.generativeai as genai
-from PIL import Image
+from google.api_core import exceptions as google_exceptions
+from PIL import Image, UnidentifiedImageError
 import io
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+from conversation_store import ConversationStore
+
 logger = logging.getLogger(__name__)
 
+@functools.cache
+def _env(name):
+    """Cached environment variable lookup"""
+    return os.getenv(name)
+
 # Configure Gemini API
-GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash')
 
-if not GEMINI_API_KEY or not TELEGRAM_BOT_TOKEN:
-    raise ValueError("Missing required environment variables: GEMINI_API_KEY and TELEGRAM_BOT_TOKEN")
+@functools.cache
+def get_model():
+    """Configure the Gemini SDK and build the model on first use.
 
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.5-flash')
+    Deferring SDK setup out of import time keeps importing this module
+    near-instant; the model is still created only once per process.
+    """
+    genai.configure(api_key=_env('GEMINI_API_KEY'))
+    return genai.GenerativeModel(GEMINI_MODEL)
+
+# Cap how long a single Gemini call may hang before failing the handler
+GEMINI_TIMEOUT_SECONDS = int(os.getenv('GEMINI_TIMEOUT_SECONDS', '60'))
+GEMINI_REQUEST_OPTIONS = {"timeout": GEMINI_TIMEOUT_SECONDS}
+
+# Gemini request batching
+GEMINI_BATCH_ENABLED = os.getenv('GEMINI_BATCH_ENABLED', '').lower() in ('1', 'true', 'yes')
+BATCH_WINDOW_MS = int(os.getenv('BATCH_WINDOW_MS', '50'))
+BATCH_MAX = int(os.getenv('BATCH_MAX', '16'))
+
+class BatchingGeminiClient:
+    """Coalesces concurrent Gemini calls into batched dispatches.
+
+    When batching is enabled, callers enqueue their prompt and await a
+    future; a background task drains the queue every BATCH_WINDOW_MS (or
+    sooner once BATCH_MAX prompts are waiting) and dispatches the whole
+    batch concurrently, amortizing connection setup across users. When
+    disabled, submit() is a plain pass-through call.
+    """
 
-# Store conversation history per user
-user_conversations = {}
+    def __init__(self, model=None, window_ms=BATCH_WINDOW_MS, batch_max=BATCH_MAX):
+        self._model = model
+        self.window = window_ms / 1000.0
+        self.batch_max = batch_max
+        self._queue = None
+        self._drain_task = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = get_model()
+        return self._model
+
+    async def submit(self, content):
+        """Generate a response for the given prompt or [prompt, image] content"""
+        if not GEMINI_BATCH_ENABLED:
+            return await self.model.generate_content_async(
+                content, request_options=GEMINI_REQUEST_OPTIONS
+            )
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._drain_task = asyncio.create_task(self._drain())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((content, future))
+        return await future
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.batch_max:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            responses = await asyncio.gather(
+                *(self.model.generate_content_async(content, request_options=GEMINI_REQUEST_OPTIONS)
+                  for content, _ in batch),
+                return_exceptions=True
+            )
+            for (_, future), response in zip(batch, responses):
+                if future.cancelled():
+                    continue
+                if isinstance(response, Exception):
+                    future.set_exception(response)
+                else:
+                    future.set_result(response)
 
-def clean_markdown(text):
-    """Remove markdown formatting for plain text display"""
-    import re
-    
-    # Remove bold (**text** or __text__)
-    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
-    text = re.sub(r'__(.*?)__', r'\1', text)
-    
-    # Remove italics (*text* or _text_)
-    text = re.sub(r'\*(.*?)\*', r'\1', text)
-    text = re.sub(r'_(.*?)_', r'\1', text)
-    
-    # Remove headers (# ## ###)
-    text = re.sub(r'^#{1,6}\s+', '', text, flags=re.MULTILINE)
-    
-    # Remove code blocks (```code```)
-    text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)
-    text = re.sub(r'`(.*?)`', r'\1', text)
-    
-    # Clean up bullet points - keep them simple
-    text = re.sub(r'^\s*[\*\-\+]\s+', '• ', text, flags=re.MULTILINE)
-    
-    return text.strip()
+gemini_client = BatchingGeminiClient()
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Send a welcome message when /start is issued"""
-    welcome_message = """
+# Retries for Gemini quota errors (429)
+GEMINI_MAX_RETRIES = 3
+
+async def generate_with_retry(content):
+    """Call Gemini, retrying quota errors with exponential backoff"""
+    delay = 1.0
+    for attempt in range(GEMINI_MAX_RETRIES):
+        try:
+            return await gemini_client.submit(content)
+        except google_exceptions.ResourceExhausted:
+            if attempt == GEMINI_MAX_RETRIES - 1:
+                raise
+            logger.warning("Gemini quota hit, retrying in %.0fs", delay)
+            await asyncio.sleep(delay)
+            delay *= 2
+
+# Per-user rate limiting
+RATE_LIMIT = int(os.getenv('RATE_LIMIT', '30'))
+RATE_WINDOW_SECONDS = int(os.getenv('RATE_WINDOW_SECONDS', '3600'))
+
+class RateLimiter:
+    """Token-bucket rate limiter keyed by user_id.
+
+    Each user holds just (last_refill_ts, tokens): tokens refill
+    continuously at RATE_LIMIT per RATE_WINDOW_SECONDS up to a burst
+    cap of RATE_LIMIT, and each accepted call spends one. O(1) per
+    check with no per-call allocations or timestamp scans, while still
+    bounding the worst-case Gemini spend a single user can generate.
+    """
+
+    def __init__(self, limit=RATE_LIMIT, window=RATE_WINDOW_SECONDS):
+        self.limit = float(limit)
+        self.refill_rate = limit / window  # tokens per second
+        self._buckets = {}
+
+    def allow(self, user_id):
+        """Spend one token if available, refilling based on elapsed time"""
+        now = time.monotonic()
+        last, tokens = self._buckets.get(user_id, (now, self.limit))
+        tokens = min(self.limit, tokens + (now - last) * self.refill_rate)
+        if tokens < 1.0:
+            self._buckets[user_id] = (now, tokens)
+            return False
+        self._buckets[user_id] = (now, tokens - 1.0)
+        return True
+
+    def sweep(self, idle_seconds):
+        """Drop buckets untouched for idle_seconds (they'd be full anyway)"""
+        cutoff = time.monotonic() - idle_seconds
+        stale = [uid for uid, (last, _) in self._buckets.items() if last < cutoff]
+        for uid in stale:
+            del self._buckets[uid]
+        return len(stale)
+
+rate_limiter = RateLimiter()
+
+# Response caching for repeated questions
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '2048'))
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+
+class ResponseCache:
+    """LRU + TTL cache of Gemini answers keyed by normalized question.
+
+    Many students ask literally identical FAQ questions; serving those
+    from memory skips a multi-second Gemini call. The cache is only
+    consulted for users with no recent conversation context, so a
+    cached answer can never depend on (or leak) another conversation.
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(message):
+        """Hash the normalized question so keys stay small and uniform"""
+        return hashlib.blake2b(message.lower().strip().encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached answer, or None if missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        answer, ts = entry
+        if time.monotonic() - ts > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return answer
+
+    def set(self, key, answer):
+        """Cache an answer, evicting the least-recently-used on overflow"""
+        self._entries[key] = (answer, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+response_cache = ResponseCache()
+
+# Conversation cache limits
+MAX_USERS = int(os.getenv('MAX_USERS', '10000'))
+TTL_SECONDS = int(os.getenv('TTL_SECONDS', '3600'))
+SWEEP_INTERVAL = 300  # How often the background sweeper checks for idle entries
+MAX_HISTORY = 20  # Messages kept per user (10 exchanges)
+
+class ConversationCache:
+    """Bounded LRU cache of per-user conversation history.
+
+    Entries are (deque, last_access_ts) pairs keyed by user_id. The cache
+    evicts the least-recently-used user when it exceeds MAX_USERS, and a
+    background sweeper drops entries idle for longer than TTL_SECONDS, so
+    memory stays bounded no matter how many users message the bot.
+    """
+
+    def __init__(self, max_users=MAX_USERS, ttl=TTL_SECONDS):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        """Return the user's history deque, creating it if needed"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            history = deque()
+            self._entries[user_id] = (history, time.monotonic())
+        else:
+            history = entry[0]
+            self._entries[user_id] = (history, time.monotonic())
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+        return history
+
+    def contains(self, user_id):
+        """True if the user already has an in-memory entry"""
+        return user_id in self._entries
+
+    def clear(self, user_id):
+        """Reset the user's history without touching their cache slot"""
+        self.get(user_id).clear()
+
+    def sweep(self):
+        """Drop entries that have been idle longer than the TTL"""
+        cutoff = time.monotonic() - self.ttl
+        stale = [uid for uid, (_, ts) in self._entries.items() if ts < cutoff]
+        for uid in stale:
+            del self._entries[uid]
+        return len(stale)
+
+# Store conversation history per user: the in-memory cache is the fast
+# path and SQLite keeps the durable copy so restarts don't lose context
+user_conversations = ConversationCache()
+conversation_db = ConversationStore(os.getenv('CONVERSATION_DB', 'conversations.db'))
+
+async def gc_idle_state():
+    """Periodically evict idle per-user state in the background.
+
+    Covers both the conversation cache and the rate-limiter buckets, so
+    every dict keyed by user_id stays bounded on long-running deploys.
+    """
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        conversations = user_conversations.sweep()
+        buckets = rate_limiter.sweep(TTL_SECONDS)
+        if conversations or buckets:
+            logger.info(
+                "GC: evicted %d idle conversation(s) and %d rate bucket(s)",
+                conversations, buckets
+            )
+
+async def load_history(user_id):
+    """Return the user's history, restoring it from SQLite on a cold miss"""
+    if user_conversations.contains(user_id):
+        return user_conversations.get(user_id)
+    history = user_conversations.get(user_id)
+    for entry in await conversation_db.load(user_id):
+        history.append(entry)
+    return history
+
+# Image preprocessing: Gemini gains nothing past ~1024px on the long
+# edge for diagram/equation photos, so shrink before uploading
+IMAGE_MAX_DIM = 1024
+IMAGE_JPEG_QUALITY = 85
+
+# History eviction policy: lfu keeps frequently-revisited turns, lru
+# keeps recently-revisited ones, fifo drops the oldest (the old behavior)
+EVICTION_POLICY = os.getenv('EVICTION_POLICY', 'lfu').lower()
+HIT_OVERLAP_THRESHOLD = 0.3  # Jaccard similarity that counts as a revisit
+
+def record_turn(history, text):
+    """Append a turn, evicting per EVICTION_POLICY when over MAX_HISTORY.
+
+    Students revisit earlier topics (definitions, recurring formulas),
+    so pure oldest-first truncation tends to evict exactly the turns
+    they come back to. LFU/LRU remove the single least-valuable entry
+    instead, preserving the chronological order of the rest.
+    """
+    # Wall-clock ts, not monotonic: entries are persisted across
+    # restarts, and monotonic clocks reset on reboot — restored
+    # entries would otherwise outrank every post-restart turn
+    history.append({'text': text, 'hits': 0, 'ts': time.time()})
+    while len(history) > MAX_HISTORY:
+        if EVICTION_POLICY == 'fifo':
+            history.popleft()
+            continue
+        # Never evict the turn just appended; islice avoids copying
+        # the deque just to skip its last entry
+        older = itertools.islice(history, len(history) - 1)
+        if EVICTION_POLICY == 'lru':
+            victim = min(older, key=lambda e: e['ts'])
+        else:
+            victim = min(older, key=lambda e: (e['hits'], e['ts']))
+        history.remove(victim)
+
+def touch_related_turns(history, user_message):
+    """Count a hit on prior turns the new message overlaps with"""
+    tokens = set(user_message.lower().split())
+    if not tokens:
+        return
+    now = time.time()
+    for entry in history:
+        entry_tokens = set(entry['text'].lower().split())
+        union = len(tokens | entry_tokens)
+        if union and len(tokens & entry_tokens) / union >= HIT_OVERLAP_THRESHOLD:
+            entry['hits'] += 1
+            entry['ts'] = now
+
+# History compaction thresholds
+COMPACT_KEEP_IMAGES = 2  # Most recent image turns kept verbatim
+COMPACT_FULL_TAIL = 6  # Most recent entries kept verbatim
+COMPACT_REPLY_CHARS = 160  # Older bot replies are trimmed to this length
+
+def compact_history(history):
+    """Compact older history entries so prompts stay small.
+
+    Recent entries go into the prompt verbatim; older bot replies are
+    trimmed to their opening characters and all but the most recent
+    image turns collapse to a caption-only marker. This preserves the
+    gist of the conversation while cutting the token count of every
+    prompt sent to Gemini.
+    """
+    entries = [entry['text'] for entry in history]
+    image_turns = [i for i, msg in enumerate(entries) if '[Sent image]' in msg]
+    keep_images = set(image_turns[-COMPACT_KEEP_IMAGES:])
+    tail_start = len(entries) - COMPACT_FULL_TAIL
+    compacted = []
+    for i, msg in enumerate(entries):
+        if '[Sent image]' in msg and i not in keep_images:
+            caption = msg.split('[Sent image]', 1)[1].strip()
+            compacted.append(f"Student: [image from earlier turn evicted — caption: {caption[:80]}]")
+        elif i < tail_start and msg.startswith('Limlo:') and len(msg) > COMPACT_REPLY_CHARS:
+            compacted.append(msg[:COMPACT_REPLY_CHARS] + "…[trimmed]")
+        else:
+            compacted.append(msg)
+    return compacted
+
+# User-facing message constants, hoisted so handlers don't reallocate
+# them on every call
+WELCOME_MESSAGE = """
 🎓 Welcome to Limlo AI Study Bot!
 
 Your personal AI study companion for Ahmadu Bello University students! 🦅
@@ -76,38 +397,21 @@ Just send me your question or image and I'll do my best to help! 📚
 
 Go ABU Great Ife! 💚🤍
     """
-    await update.message.reply_text(welcome_message)
-    
-    # Initialize conversation for new users
-    user_id = update.effective_user.id
-    if user_id not in user_conversations:
-        user_conversations[user_id] = []
-    
-    logger.info(f"User {user_id} started the bot")
 
-async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Clear the conversation history for the user"""
-    user_id = update.effective_user.id
-    user_conversations[user_id] = []
-    await update.message.reply_text("✅ Conversation history cleared! Starting fresh.")
-    logger.info(f"User {user_id} cleared conversation history")
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Provide help information"""
-    help_text = """
+HELP_TEXT = """
 📖 How to use Limlo AI Study Bot:
 
 1️⃣ Ask questions naturally:
    "What is photosynthesis?"
    "Explain Newton's laws of motion"
-   
+
 2️⃣ Request step-by-step solutions:
    "How do I solve quadratic equations?"
    "Walk me through mitosis"
-   
+
 3️⃣ Get study tips:
    "How can I memorize the periodic table?"
-   
+
 4️⃣ Practice problems:
    "Give me a practice problem on algebra"
 
@@ -117,7 +421,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
    • Handwritten notes
    • Textbook pages
    • Lab results
-   
+
    Add a caption with your question about the image!
 
 💡 Tips:
@@ -132,32 +436,38 @@ Powered by Limlo AI - Created by Daniel Kopret and Ahmed
 
 Go Great Ife! 💚🤍
     """
-    await update.message.reply_text(help_text)
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle incoming text messages and generate responses using Gemini"""
-    user_id = update.effective_user.id
-    user_message = update.message.text
-    
-    # Initialize conversation history if needed
-    if user_id not in user_conversations:
-        user_conversations[user_id] = []
-    
-    # Send "thinking" message
-    thinking_messages = [
-        "🤔 Thinking...",
-        "💭 Let me think about that...",
-        "🧠 Processing your question...",
-        "📚 Looking into this...",
-        "🔍 Analyzing..."
-    ]
-    
-    import random
-    thinking_msg = await update.message.reply_text(random.choice(thinking_messages))
-    
-    try:
-        # Create a study-focused prompt
-        system_prompt = """You are Limlo AI, created by Daniel Kopret and Ahmed, a helpful AI study assistant for Ahmadu Bello University (ABU) students. Your role is to:
+RATE_LIMIT_MESSAGE = (
+    "🚦 Slow down! You've reached your question limit for this hour. "
+    "Take a short study break and try again soon. 📚"
+)
+
+ERROR_TEXT = """
+😔 Sorry, I encountered an error processing your question.
+
+Please try:
+• Rephrasing your question
+• Using /clear to start fresh
+• Asking a different question
+
+If the problem persists, please contact support.
+        """
+
+ERROR_IMG = """
+😔 Sorry, I encountered an error analyzing your image.
+
+Please try:
+• Sending a clearer image
+• Adding a caption describing what you need help with
+• Making sure the image is not too large
+
+If the problem persists, please contact support.
+        """
+
+# System prompts are module-level constants so each message reuses the
+# same string object and the prompt prefix stays byte-identical across
+# calls (which keeps it cacheable on the Gemini side)
+SYSTEM_PROMPT_TEXT = """You are Limlo AI, created by Daniel Kopret and Ahmed, a helpful AI study assistant for Ahmadu Bello University (ABU) students. Your role is to:
 - Explain concepts clearly and concisely
 - Break down complex topics into understandable parts
 - Provide examples relevant to ABU students when possible
@@ -179,134 +489,8 @@ CRITICAL FORMATTING RULES:
 - Use line breaks for separation
 
 When helping with assignments, guide the student through the problem rather than just providing the answer."""
-        
-        # Build conversation context with recent history (last 5 exchanges)
-        conversation_context = ""
-        recent_history = user_conversations[user_id][-10:]  # Last 10 messages (5 exchanges)
-        
-        if recent_history:
-            conversation_context = "\n\nRecent conversation:\n"
-            for msg in recent_history:
-                conversation_context += f"{msg}\n"
-        
-        # Create full prompt
-        full_prompt = f"{system_prompt}{conversation_context}\n\nStudent question: {user_message}"
-        
-        # Generate response
-        response = model.generate_content(full_prompt)
-        bot_response = response.text
-        
-        # Clean up markdown formatting
-        bot_response = clean_markdown(bot_response)
-        
-        # Delete the "thinking" message
-        await context.bot.delete_message(
-            chat_id=update.effective_chat.id,
-            message_id=thinking_msg.message_id
-        )
-        
-        # Store conversation
-        user_conversations[user_id].append(f"Student: {user_message}")
-        user_conversations[user_id].append(f"Limlo: {bot_response}")
-        
-        # Keep only last 20 messages to manage memory
-        if len(user_conversations[user_id]) > 20:
-            user_conversations[user_id] = user_conversations[user_id][-20:]
-        
-        # Send response (split if too long)
-        # Telegram max message length is 4096 characters
-        max_length = 4000  # Leave some buffer
-        
-        if len(bot_response) <= max_length:
-            await update.message.reply_text(bot_response)
-        else:
-            # Split message into chunks
-            chunks = []
-            current_chunk = ""
-            
-            # Split by paragraphs first
-            paragraphs = bot_response.split('\n\n')
-            
-            for paragraph in paragraphs:
-                if len(current_chunk) + len(paragraph) + 2 <= max_length:
-                    current_chunk += paragraph + "\n\n"
-                else:
-                    if current_chunk:
-                        chunks.append(current_chunk.strip())
-                    current_chunk = paragraph + "\n\n"
-            
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            
-            # Send each chunk
-            for i, chunk in enumerate(chunks):
-                if i == 0:
-                    await update.message.reply_text(chunk)
-                else:
-                    await update.message.reply_text(f"(continued...)\n\n{chunk}")
-        
-        logger.info(f"Responded to user {user_id}")
-        
-    except Exception as e:
-        logger.error(f"Error generating response: {e}")
-        
-        # Delete the "thinking" message if it exists
-        try:
-            await context.bot.delete_message(
-                chat_id=update.effective_chat.id,
-                message_id=thinking_msg.message_id
-            )
-        except:
-            pass
-        
-        error_message = """
-😔 Sorry, I encountered an error processing your question. 
 
-Please try:
-• Rephrasing your question
-• Using /clear to start fresh
-• Asking a different question
-
-If the problem persists, please contact support.
-        """
-        await update.message.reply_text(error_message)
-
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle incoming photos and analyze them using Gemini Vision"""
-    user_id = update.effective_user.id
-    
-    # Initialize conversation history if needed
-    if user_id not in user_conversations:
-        user_conversations[user_id] = []
-    
-    # Send "analyzing" message
-    analyzing_messages = [
-        "📸 Analyzing your image...",
-        "🔍 Examining the image...",
-        "👀 Looking at your image...",
-        "🧠 Processing the image...",
-        "📊 Analyzing the diagram..."
-    ]
-    
-    import random
-    thinking_msg = await update.message.reply_text(random.choice(analyzing_messages))
-    
-    try:
-        # Get the largest photo (highest resolution)
-        photo = update.message.photo[-1]
-        
-        # Download the photo
-        photo_file = await context.bot.get_file(photo.file_id)
-        photo_bytes = await photo_file.download_as_bytearray()
-        
-        # Convert to PIL Image
-        image = Image.open(io.BytesIO(photo_bytes))
-        
-        # Get caption if provided
-        caption = update.message.caption if update.message.caption else "What can you tell me about this image? Please analyze it in detail."
-        
-        # Create a study-focused prompt for image analysis
-        system_prompt = """You are Limlo AI, created by Daniel Kopret and Ahmed, analyzing an image for an Ahmadu Bello University student. When analyzing images:
+SYSTEM_PROMPT_IMG = """You are Limlo AI, created by Daniel Kopret and Ahmed, analyzing an image for an Ahmadu Bello University student. When analyzing images:
 - Identify what the image contains (diagram, equation, notes, chart, etc.)
 - Explain key concepts shown clearly and concisely
 - If it's a problem, guide the student through solving it step by step
@@ -319,100 +503,371 @@ When asked who you are or who created you, identify yourself as Limlo AI, create
 
 CRITICAL FORMATTING RULES:
 - Never use ** for bold
-- Never use * for italics  
+- Never use * for italics
 - Never use # for headers
 - Never use - or * for bullet points
 - Use plain text only
 - Use line breaks for separation
 - Be concise and to the point"""
+
+def clean_markdown(text):
+    """Remove markdown formatting for plain text display"""
+    import re
+    
+    # Remove bold (**text** or __text__)
+    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
+    text = re.sub(r'__(.*?)__', r'\1', text)
+    
+    # Remove italics (*text* or _text_)
+    text = re.sub(r'\*(.*?)\*', r'\1', text)
+    text = re.sub(r'_(.*?)_', r'\1', text)
+    
+    # Remove headers (# ## ###)
+    text = re.sub(r'^#{1,6}\s+', '', text, flags=re.MULTILINE)
+    
+    # Remove code blocks (```code```)
+    text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)
+    text = re.sub(r'`(.*?)`', r'\1', text)
+    
+    # Clean up bullet points - keep them simple
+    text = re.sub(r'^\s*[\*\-\+]\s+', '• ', text, flags=re.MULTILINE)
+    
+    return text.strip()
+
+def prepare_image(photo_buf):
+    """Decode, downscale and re-encode an uploaded photo to JPEG bytes.
+
+    Returning the compressed bytes (rather than a PIL object) lets the
+    Gemini SDK send them as-is instead of decoding and re-encoding the
+    image again internally. This is pure blocking CPU work, so callers
+    should run it via asyncio.to_thread to keep the event loop free.
+    """
+    image = Image.open(photo_buf)
+    if image.format == "JPEG":
+        # Let libjpeg decode straight to roughly the target size
+        # (DCT scaling), skipping most of the IDCT work for large
+        # photos; draft() is a no-op for other formats
+        image.draft("RGB", (IMAGE_MAX_DIM, IMAGE_MAX_DIM))
+    image.thumbnail((IMAGE_MAX_DIM, IMAGE_MAX_DIM), Image.Resampling.LANCZOS)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    buf = io.BytesIO()
+    image.save(buf, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
+
+def chunk_for_telegram(text, max_len=4000):
+    """Split a long response into Telegram-sized chunks.
+
+    Telegram caps messages at 4096 characters; we split on paragraph
+    boundaries (leaving some buffer) and join each chunk once, so there
+    is no quadratic string concatenation. A single paragraph longer
+    than max_len is hard-sliced rather than sent oversized.
+    """
+    if len(text) <= max_len:
+        return [text]
+    chunks = []
+    buf = []
+    length = 0
+    for paragraph in text.split('\n\n'):
+        while len(paragraph) > max_len:
+            if buf:
+                chunks.append('\n\n'.join(buf))
+                buf = []
+                length = 0
+            chunks.append(paragraph[:max_len])
+            paragraph = paragraph[max_len:]
+        if buf and length + len(paragraph) + 2 > max_len:
+            chunks.append('\n\n'.join(buf))
+            buf = []
+            length = 0
+        if paragraph:
+            buf.append(paragraph)
+            length += len(paragraph) + 2
+    if buf:
+        chunks.append('\n\n'.join(buf))
+    return chunks
+
+TYPING_REFRESH_SECONDS = 4  # Telegram expires the typing indicator after ~5s
+
+async def keep_typing(bot, chat_id):
+    """Show "typing..." until cancelled, refreshing before it expires.
+
+    Run as a task alongside a Gemini call; cancel it once the response
+    arrives. Keeps the indicator alive for calls slower than Telegram's
+    ~5 second auto-expiry without any message to clean up afterwards.
+    """
+    while True:
+        await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        await asyncio.sleep(TYPING_REFRESH_SECONDS)
+
+SEND_BATCH_SIZE = 10  # Concurrent sends per group; stays under Telegram's per-chat limits
+
+async def send_response(message, text):
+    """Send a response, splitting long text and dispatching chunks concurrently.
+
+    Chunks within a group go out in one round trip via gather; very long
+    responses are sent in groups of SEND_BATCH_SIZE so a burst of sends
+    can't trip Telegram's per-chat rate limit.
+    """
+    chunks = chunk_for_telegram(text)
+    for start in range(0, len(chunks), SEND_BATCH_SIZE):
+        await asyncio.gather(*(
+            message.reply_text(chunk if i == 0 else f"(continued...)\n\n{chunk}")
+            for i, chunk in enumerate(chunks[start:start + SEND_BATCH_SIZE], start)
+        ))
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send a welcome message when /start is issued"""
+    await update.message.reply_text(WELCOME_MESSAGE)
+    
+    # Initialize conversation for new users
+    user_id = update.effective_user.id
+    await load_history(user_id)
+
+    logger.info("User %s started the bot", user_id)
+
+async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Clear the conversation history for the user"""
+    user_id = update.effective_user.id
+    user_conversations.clear(user_id)
+    await conversation_db.clear(user_id)
+    await update.message.reply_text("✅ Conversation history cleared! Starting fresh.")
+    logger.info("User %s cleared conversation history", user_id)
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Provide help information"""
+    await update.message.reply_text(HELP_TEXT)
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle incoming text messages and generate responses using Gemini"""
+    user_id = update.effective_user.id
+    user_message = update.message.text
+
+    # Check the rate limit before doing any Telegram or Gemini work
+    if not rate_limiter.allow(user_id):
+        await update.message.reply_text(RATE_LIMIT_MESSAGE)
+        logger.info("Rate limited user %s", user_id)
+        return
+
+    logger.info("Accepted message from user %s", user_id)
+    history = await load_history(user_id)
+
+    try:
+        # Mark prior turns this message revisits so eviction keeps them
+        touch_related_turns(history, user_message)
+
+        # Build conversation context from the full (write-time-bounded)
+        # history. Trimming happens only when turns are recorded, never
+        # here, so the prompt prefix doesn't shift on every read and
+        # Gemini's prompt-prefix caching can hit across turns
+        recent_history = compact_history(history)
+
+        # Serve repeated context-free questions straight from the cache
+        bot_response = None
+        cache_key = None
+        if not recent_history:
+            cache_key = response_cache.key(user_message)
+            bot_response = response_cache.get(cache_key)
+            if bot_response is not None:
+                logger.info("Response cache hit for user %s", user_id)
+
+        if bot_response is None:
+            # Only show "typing..." when a real Gemini call is coming;
+            # cache hits reply fast enough that the indicator (an extra
+            # Telegram API call) would just be noise
+            typing_task = asyncio.create_task(
+                keep_typing(context.bot, update.effective_chat.id)
+            )
+            try:
+                # Create full prompt with a single join (no quadratic concat)
+                parts = [SYSTEM_PROMPT_TEXT]
+                if recent_history:
+                    parts.append("\n".join(("Recent conversation:", *recent_history)))
+                parts.append(f"Student question: {user_message}")
+                full_prompt = "\n\n".join(parts)
+
+                # Generate response
+                response = await generate_with_retry(full_prompt)
+            finally:
+                typing_task.cancel()
+
+            # Clean up markdown formatting
+            bot_response = clean_markdown(response.text)
+
+            if cache_key is not None:
+                response_cache.set(cache_key, bot_response)
+
+        # Store conversation (record_turn evicts per EVICTION_POLICY)
+        record_turn(history, f"Student: {user_message}")
+        record_turn(history, f"Limlo: {bot_response}")
+        await conversation_db.save(user_id, history)
+
+        # Send response (split if too long)
+        await send_response(update.message, bot_response)
+
+        logger.info("Responded to user %s", user_id)
         
-        prompt = f"{system_prompt}\n\nStudent's question about the image: {caption}"
-        
-        # Generate response using vision model
-        response = model.generate_content([prompt, image])
-        bot_response = response.text
-        
-        # Clean up markdown formatting
-        bot_response = clean_markdown(bot_response)
-        
-        # Delete the "analyzing" message
-        await context.bot.delete_message(
-            chat_id=update.effective_chat.id,
-            message_id=thinking_msg.message_id
+    except google_exceptions.GoogleAPIError as e:
+        logger.error("Gemini error for user %s: %s", user_id, e)
+        await update.message.reply_text(ERROR_TEXT)
+    except telegram_error.TelegramError as e:
+        # Replying probably won't fare better than the call that failed
+        logger.warning("Telegram error for user %s: %s", user_id, e)
+    except Exception:
+        logger.exception("Unexpected error handling message from user %s", user_id)
+        await update.message.reply_text(ERROR_TEXT)
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle incoming photos and analyze them using Gemini Vision"""
+    user_id = update.effective_user.id
+
+    # Check the rate limit before doing any Telegram or Gemini work
+    if not rate_limiter.allow(user_id):
+        await update.message.reply_text(RATE_LIMIT_MESSAGE)
+        logger.info("Rate limited user %s", user_id)
+        return
+
+    logger.info("Accepted photo from user %s", user_id)
+    history = await load_history(user_id)
+
+    # Show "typing..." while we download and analyze, refreshing it for
+    # calls slower than Telegram's ~5s indicator expiry
+    typing_task = asyncio.create_task(
+        keep_typing(context.bot, update.effective_chat.id)
+    )
+
+    try:
+        # Pick the smallest size tier that is still detailed enough,
+        # rather than always downloading the largest resolution
+        photo = next(
+            (p for p in update.message.photo if p.width >= IMAGE_MAX_DIM),
+            update.message.photo[-1]
         )
+
+        # Download the photo straight into one buffer (no intermediate
+        # bytearray copy, so half the peak memory per upload)
+        photo_file = await context.bot.get_file(photo.file_id)
+        photo_buf = io.BytesIO()
+        await photo_file.download_to_memory(photo_buf)
+        photo_buf.seek(0)
+
+        # Downscale and re-encode on a worker thread so decode/resample
+        # CPU time doesn't block other users' handlers
+        image_part = {
+            "mime_type": "image/jpeg",
+            "data": await asyncio.to_thread(prepare_image, photo_buf),
+        }
+
+        # Get caption if provided
+        caption = update.message.caption if update.message.caption else "What can you tell me about this image? Please analyze it in detail."
         
-        # Store conversation
-        user_conversations[user_id].append(f"Student: [Sent image] {caption}")
-        user_conversations[user_id].append(f"Limlo: {bot_response}")
-        
-        # Keep only last 20 messages to manage memory
-        if len(user_conversations[user_id]) > 20:
-            user_conversations[user_id] = user_conversations[user_id][-20:]
-        
-        # Send response (split if too long)
-        max_length = 4000
-        
-        if len(bot_response) <= max_length:
-            await update.message.reply_text(bot_response)
+        # Re-sends of the same photo and caption (shared homework shots
+        # make this common) are served from the cache; the image prompt
+        # never includes conversation history, so this is context-safe
+        image_digest = hashlib.blake2b(image_part["data"]).hexdigest()
+        cache_key = response_cache.key(f"{caption}\x00{image_digest}")
+        bot_response = response_cache.get(cache_key)
+        if bot_response is not None:
+            logger.info("Image response cache hit for user %s", user_id)
         else:
-            # Split message into chunks
-            chunks = []
-            current_chunk = ""
-            
-            paragraphs = bot_response.split('\n\n')
-            
-            for paragraph in paragraphs:
-                if len(current_chunk) + len(paragraph) + 2 <= max_length:
-                    current_chunk += paragraph + "\n\n"
-                else:
-                    if current_chunk:
-                        chunks.append(current_chunk.strip())
-                    current_chunk = paragraph + "\n\n"
-            
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            
-            # Send each chunk
-            for i, chunk in enumerate(chunks):
-                if i == 0:
-                    await update.message.reply_text(chunk)
-                else:
-                    await update.message.reply_text(f"(continued...)\n\n{chunk}")
-        
-        logger.info(f"Analyzed image for user {user_id}")
-        
-    except Exception as e:
-        logger.error(f"Error analyzing image: {e}")
-        
-        # Delete the "analyzing" message if it exists
-        try:
-            await context.bot.delete_message(
-                chat_id=update.effective_chat.id,
-                message_id=thinking_msg.message_id
-            )
-        except:
-            pass
-        
-        error_message = """
-😔 Sorry, I encountered an error analyzing your image. 
+            prompt = f"{SYSTEM_PROMPT_IMG}\n\nStudent's question about the image: {caption}"
 
-Please try:
-• Sending a clearer image
-• Adding a caption describing what you need help with
-• Making sure the image is not too large
+            # Generate response using vision model
+            response = await generate_with_retry([prompt, image_part])
+            bot_response = response.text
 
-If the problem persists, please contact support.
-        """
-        await update.message.reply_text(error_message)
+            # Clean up markdown formatting
+            bot_response = clean_markdown(bot_response)
+            response_cache.set(cache_key, bot_response)
+
+        typing_task.cancel()
+
+        # Store conversation (record_turn evicts per EVICTION_POLICY)
+        record_turn(history, f"Student: [Sent image] {caption}")
+        record_turn(history, f"Limlo: {bot_response}")
+        await conversation_db.save(user_id, history)
+
+        # Send response (split if too long)
+        await send_response(update.message, bot_response)
+
+        logger.info("Analyzed image for user %s", user_id)
+
+    except UnidentifiedImageError:
+        logger.warning("Could not decode image from user %s", user_id)
+        await update.message.reply_text(ERROR_IMG)
+    except google_exceptions.GoogleAPIError as e:
+        logger.error("Gemini error for user %s: %s", user_id, e)
+        await update.message.reply_text(ERROR_IMG)
+    except telegram_error.TelegramError as e:
+        # Replying probably won't fare better than the call that failed
+        logger.warning("Telegram error for user %s: %s", user_id, e)
+    except Exception:
+        logger.exception("Unexpected error analyzing image from user %s", user_id)
+        await update.message.reply_text(ERROR_IMG)
+    finally:
+        typing_task.cancel()
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Log errors caused by updates"""
-    logger.error(f"Update {update} caused error {context.error}")
+    logger.error("Update %s caused error %s", update, context.error)
+
+async def post_init(application):
+    """Start background tasks once the event loop is running"""
+    application.create_task(gc_idle_state())
+
+    # Warm up the process-wide Gemini channel with a cheap call so the
+    # first user doesn't pay for connection/TLS setup; every later
+    # request multiplexes over this same client
+    try:
+        await get_model().count_tokens_async("warmup")
+    except Exception as e:
+        logger.warning("Gemini connection warmup failed: %s", e)
+
+def setup_logging():
+    """Configure logging with the actual I/O on a background thread.
+
+    The default StreamHandler writes to stderr synchronously, which can
+    block the event loop under load. Handlers route records into a
+    queue instead; a QueueListener thread does the real writes.
+    """
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    root = logging.getLogger()
+    stream_handlers = root.handlers[:]
+    for handler in stream_handlers:
+        root.removeHandler(handler)
+    log_queue = queue.Queue(-1)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *stream_handlers)
+    listener.start()
+    atexit.register(listener.stop)
 
 def main():
     """Start the bot"""
-    # Create application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    setup_logging()
+
+    if not _env('GEMINI_API_KEY') or not _env('TELEGRAM_BOT_TOKEN'):
+        raise ValueError("Missing required environment variables: GEMINI_API_KEY and TELEGRAM_BOT_TOKEN")
+
+    # Create application with a larger Telegram connection pool: the
+    # default 1-connection pool serializes concurrent sends and file
+    # downloads behind each other. getUpdates keeps its own small pool
+    # so long-polls never compete with handler traffic.
+    application = (
+        Application.builder()
+        .token(_env('TELEGRAM_BOT_TOKEN'))
+        .request(HTTPXRequest(
+            connection_pool_size=128,
+            connect_timeout=5.0,
+            read_timeout=30.0,
+            pool_timeout=10.0
+        ))
+        .get_updates_request(HTTPXRequest(connection_pool_size=8))
+        .post_init(post_init)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -424,9 +879,21 @@ def main():
     # Add error handler
     application.add_error_handler(error_handler)
     
-    # Start the bot
+    # Start the bot. With WEBHOOK_URL set, Telegram pushes updates to us
+    # and we skip the getUpdates long-poll round trip entirely; without
+    # it (e.g. no inbound HTTP available) we fall back to polling.
     logger.info("Starting Limlo Study Bot...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    webhook_url = _env('WEBHOOK_URL')
+    if webhook_url:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv('PORT', '8443')),
+            webhook_url=webhook_url,
+            secret_token=_env('WEBHOOK_SECRET'),
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
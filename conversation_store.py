@@ -0,0 +1,99 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+import orjson
+import zstandard
+
+# Blobs above this size get zstd-compressed; verbose Gemini answers
+# shrink roughly 4x, short histories aren't worth the round trip
+COMPRESS_MIN_BYTES = 1024
+
+_compressor = zstandard.ZstdCompressor(level=3)
+_decompressor = zstandard.ZstdDecompressor()
+
+class ConversationStore:
+    """SQLite-backed persistence for per-user conversation history.
+
+    The in-process cache in bot.py stays the fast path; this store is
+    the durable copy, so a restart no longer wipes every student's
+    context. History is saved as one serialized blob per user — the
+    history itself is already bounded, so rows stay small. sqlite3 is
+    synchronous, so all calls are pushed through asyncio.to_thread to
+    keep the event loop free.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "user_id INTEGER PRIMARY KEY, history BLOB, ts REAL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _load(self, user_id):
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT history FROM conversations WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+        if row is None:
+            return []
+        return self._deserialize(row[0])
+
+    def _save(self, user_id, entries):
+        blob = self._serialize(entries)
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO conversations (user_id, history, ts) "
+                "VALUES (?, ?, ?)",
+                (user_id, blob, time.time())
+            )
+            conn.commit()
+
+    def _clear(self, user_id):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+            conn.commit()
+
+    @staticmethod
+    def _serialize(entries):
+        # One prefix byte marks the encoding: 'z' = zstd-compressed
+        # orjson, 'r' = raw orjson
+        blob = orjson.dumps(entries)
+        if len(blob) > COMPRESS_MIN_BYTES:
+            return b"z" + _compressor.compress(blob)
+        return b"r" + blob
+
+    @staticmethod
+    def _deserialize(blob):
+        blob = bytes(blob)
+        if blob[:1] == b"z":
+            return orjson.loads(_decompressor.decompress(blob[1:]))
+        if blob[:1] == b"r":
+            return orjson.loads(blob[1:])
+        # Rows written before the prefix scheme are plain JSON
+        return orjson.loads(blob)
+
+    async def load(self, user_id):
+        """Return the user's persisted history entries (possibly empty)"""
+        return await asyncio.to_thread(self._load, user_id)
+
+    async def save(self, user_id, history):
+        """Persist the user's full (bounded) history"""
+        await asyncio.to_thread(self._save, user_id, list(history))
+
+    async def clear(self, user_id):
+        """Drop the user's persisted history"""
+        await asyncio.to_thread(self._clear, user_id)